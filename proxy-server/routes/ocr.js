@@ -33,13 +33,6 @@ router.post('/', async (req, res) => {
 
     console.log('📸 [OCR-API] Received OCR request for:', url || title || 'Unknown page');
 
-    // Call Python OCR service
-    const ocrScriptPath = path.join(__dirname, '../services/ocr_service.py');
-
-    console.log('🐍 [OCR-API] Starting Python OCR process...');
-    console.log(`🐍 [OCR-API] Script path: ${ocrScriptPath}`);
-    console.log(`🐍 [OCR-API] Image size: ${image.length} chars`);
-
     // Prepare data to send to Python (include context)
     const requestData = {
       image,
@@ -49,73 +42,11 @@ router.post('/', async (req, res) => {
       existingTags
     };
 
-    // Use stdin to pass image data instead of command line argument
-    // to avoid ENAMETOOLONG error on Windows
-    const pythonProcess = spawn('python', [ocrScriptPath], {
-      cwd: path.join(__dirname, '../services'),
-      env: { ...process.env }
-    });
-
-    console.log('✅ [OCR-API] Python process started');
-
-    // Write request data as JSON to stdin
-    pythonProcess.stdin.write(JSON.stringify(requestData));
-    pythonProcess.stdin.end();
-
-    let stdout = '';
-    let stderr = '';
-
-    // Configure encoding for Windows - use utf8 explicitly
-    pythonProcess.stdout.setEncoding('utf8');
-    pythonProcess.stderr.setEncoding('utf8');
-
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data;
-      console.log('📤 [OCR-PYTHON] stdout chunk:', data.substring(0, 200) + (data.length > 200 ? '...' : ''));
-    });
-
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data;
-      console.error('❌ [OCR-PYTHON] stderr:', data);
-    });
-
-    // Wait for process to complete
-    console.log('⏳ [OCR-API] Waiting for Python process to complete...');
-    const result = await new Promise((resolve, reject) => {
-      pythonProcess.on('close', (code) => {
-        console.log(`🏁 [OCR-API] Python process closed with code: ${code}`);
-        console.log(`📊 [OCR-API] stdout length: ${stdout.length}`);
-        console.log(`📊 [OCR-API] stderr length: ${stderr.length}`);
-
-        if (code === 0) {
-          try {
-            console.log('📝 [OCR-API] Parsing JSON output...');
-            const data = JSON.parse(stdout);
-            console.log('✅ [OCR-API] JSON parsed successfully');
-            resolve(data);
-          } catch (parseError) {
-            console.error('❌ [OCR-API] JSON parse error:', parseError.message);
-            console.error('❌ [OCR-API] stdout:', stdout.substring(0, 500));
-            reject(new Error(`Failed to parse OCR output: ${parseError.message}`));
-          }
-        } else {
-          console.error('❌ [OCR-API] Process exited with non-zero code');
-          reject(new Error(`OCR process exited with code ${code}: ${stderr}`));
-        }
-      });
-
-      pythonProcess.on('error', (error) => {
-        console.error('❌ [OCR-API] Python process error:', error);
-        reject(new Error(`Failed to start OCR process: ${error.message}`));
-      });
-
-      // Set timeout (2 minutes)
-      setTimeout(() => {
-        console.error('❌ [OCR-API] Process timeout (120s), killing...');
-        pythonProcess.kill();
-        reject(new Error('OCR processing timeout (120s)'));
-      }, 120000);
-    });
+    // Prefer the persistent OCR service when configured, otherwise spawn
+    // a one-shot Python process for this request
+    const result = process.env.OCR_SERVICE_URL
+      ? await callOcrService(process.env.OCR_SERVICE_URL, requestData)
+      : await runOcrProcess(requestData);
 
     if (result.success) {
       console.log('✅ [OCR-API] OCR processing completed');
@@ -146,4 +77,121 @@ router.post('/', async (req, res) => {
   }
 });
 
+// Send the request to the persistent OCR service (python ocr_service.py --serve)
+async function callOcrService(serviceUrl, requestData) {
+  console.log(`🐍 [OCR-API] Calling OCR service at ${serviceUrl}`);
+
+  const controller = new AbortController();
+  const timeout = setTimeout(() => controller.abort(), 120000);
+
+  try {
+    const response = await fetch(serviceUrl, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(requestData),
+      signal: controller.signal
+    });
+
+    console.log(`🏁 [OCR-API] OCR service responded with status: ${response.status}`);
+
+    if (!response.ok) {
+      // Error bodies may not be JSON (e.g. a proxy's HTML error page)
+      const body = await response.text();
+      let message;
+      try {
+        message = JSON.parse(body).error;
+      } catch (parseError) {
+        message = null;
+      }
+      throw new Error(message || `OCR service returned status ${response.status}`);
+    }
+    return await response.json();
+  } catch (error) {
+    if (error.name === 'AbortError') {
+      console.error('❌ [OCR-API] OCR service timeout (120s)');
+      throw new Error('OCR processing timeout (120s)');
+    }
+    throw error;
+  } finally {
+    clearTimeout(timeout);
+  }
+}
+
+// Run the Python OCR script once for this request
+function runOcrProcess(requestData) {
+  const ocrScriptPath = path.join(__dirname, '../services/ocr_service.py');
+
+  console.log('🐍 [OCR-API] Starting Python OCR process...');
+  console.log(`🐍 [OCR-API] Script path: ${ocrScriptPath}`);
+  console.log(`🐍 [OCR-API] Image size: ${requestData.image.length} chars`);
+
+  // Use stdin to pass image data instead of command line argument
+  // to avoid ENAMETOOLONG error on Windows
+  const pythonProcess = spawn('python', [ocrScriptPath], {
+    cwd: path.join(__dirname, '../services'),
+    env: { ...process.env }
+  });
+
+  console.log('✅ [OCR-API] Python process started');
+
+  // Write request data as JSON to stdin
+  pythonProcess.stdin.write(JSON.stringify(requestData));
+  pythonProcess.stdin.end();
+
+  let stdout = '';
+  let stderr = '';
+
+  // Configure encoding for Windows - use utf8 explicitly
+  pythonProcess.stdout.setEncoding('utf8');
+  pythonProcess.stderr.setEncoding('utf8');
+
+  pythonProcess.stdout.on('data', (data) => {
+    stdout += data;
+    console.log('📤 [OCR-PYTHON] stdout chunk:', data.substring(0, 200) + (data.length > 200 ? '...' : ''));
+  });
+
+  pythonProcess.stderr.on('data', (data) => {
+    stderr += data;
+    console.error('❌ [OCR-PYTHON] stderr:', data);
+  });
+
+  // Wait for process to complete
+  console.log('⏳ [OCR-API] Waiting for Python process to complete...');
+  return new Promise((resolve, reject) => {
+    pythonProcess.on('close', (code) => {
+      console.log(`🏁 [OCR-API] Python process closed with code: ${code}`);
+      console.log(`📊 [OCR-API] stdout length: ${stdout.length}`);
+      console.log(`📊 [OCR-API] stderr length: ${stderr.length}`);
+
+      if (code === 0) {
+        try {
+          console.log('📝 [OCR-API] Parsing JSON output...');
+          const data = JSON.parse(stdout);
+          console.log('✅ [OCR-API] JSON parsed successfully');
+          resolve(data);
+        } catch (parseError) {
+          console.error('❌ [OCR-API] JSON parse error:', parseError.message);
+          console.error('❌ [OCR-API] stdout:', stdout.substring(0, 500));
+          reject(new Error(`Failed to parse OCR output: ${parseError.message}`));
+        }
+      } else {
+        console.error('❌ [OCR-API] Process exited with non-zero code');
+        reject(new Error(`OCR process exited with code ${code}: ${stderr}`));
+      }
+    });
+
+    pythonProcess.on('error', (error) => {
+      console.error('❌ [OCR-API] Python process error:', error);
+      reject(new Error(`Failed to start OCR process: ${error.message}`));
+    });
+
+    // Set timeout (2 minutes)
+    setTimeout(() => {
+      console.error('❌ [OCR-API] Process timeout (120s), killing...');
+      pythonProcess.kill();
+      reject(new Error('OCR processing timeout (120s)'));
+    }, 120000);
+  });
+}
+
 export default router;
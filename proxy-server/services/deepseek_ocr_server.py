@@ -7,33 +7,102 @@ Author: Ling Luo
 """
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from PIL import Image
+from PIL import Image, ImageOps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import io
-import base64
+import asyncio
 import torch
 import os
 import sys
+import tempfile
+import importlib.util
 from pathlib import Path
 import logging
-
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import pybase64 as base64  # SIMD-accelerated base64 decoding
+except ImportError:
+    import base64
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()  # libjpeg-turbo SIMD decoder for JPEG uploads
+except (ImportError, OSError, RuntimeError):
+    # Package missing or libjpeg-turbo shared library not found
+    turbo_jpeg = None
+
+# Setup logging: handlers only enqueue records and a listener thread writes
+# them out, so request handling never blocks on stderr
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="DeepSeek-OCR Server")
+app = FastAPI(title="DeepSeek-OCR Server", default_response_class=ORJSONResponse)
 
 # Model configuration
 MODEL_PATH = Path(r"C:\\Ling Luo\\softwares\\Web2PG\\model\\deepseek-ai\\DeepSeek-OCR")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Load weights directly in bfloat16 where the GPU supports it
+DTYPE = torch.bfloat16 if DEVICE == "cuda" and torch.cuda.is_bf16_supported() else torch.float32
+
+# Fused attention kernel: FlashAttention-2 if installed, otherwise PyTorch SDPA
+ATTN_IMPLEMENTATION = "flash_attention_2" if importlib.util.find_spec("flash_attn") else "sdpa"
+
+# torch.compile the vision encoders (set DEEPSEEK_OCR_COMPILE=0 to run eager).
+# "reduce-overhead" replays them as CUDA graphs; the 1024x1024 global view is
+# fixed, but the 640x640 crop batch varies with image size, and each new crop
+# count compiles and records another graph on first use
+USE_TORCH_COMPILE = DEVICE == "cuda" and os.getenv("DEEPSEEK_OCR_COMPILE", "1") == "1"
+COMPILE_MODE = "reduce-overhead"
+VISION_ENCODERS = ("sam_model", "vision_model")
+
+# Optional bitsandbytes weight-only quantization of the language decoder:
+# DEEPSEEK_OCR_QUANTIZATION=8bit or 4bit (NF4); vision modules stay in DTYPE
+QUANTIZATION = os.getenv("DEEPSEEK_OCR_QUANTIZATION", "").lower()
+QUANTIZATION_SKIP_MODULES = [*VISION_ENCODERS, "projector", "lm_head"]
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+EXIF_ORIENTATION = 0x0112
+
+# Fallback file for infer() when images can't be passed in memory, on tmpfs if available
+STAGED_IMAGE_DIR = Path("/dev/shm") if os.path.isdir("/dev/shm") else Path(tempfile.gettempdir())
+STAGED_IMAGE_PATH = STAGED_IMAGE_DIR / f"deepseek_ocr_worker_{os.getpid()}.bmp"
+
+# Distinct prompt segments whose token ids are kept
+PROMPT_CACHE_SIZE = 64
+
 # Global model variable
 model = None
 tokenizer = None
 
+# Decoded images handed to model.infer in memory, keyed by the image_file placeholder
+preloaded_images = {}
+image_hook_installed = False
+
+# Pending OCR requests, consumed by a single GPU worker task
+ocr_queue = None
+ocr_worker_task = None
+
+# All model work (loading, warmup, inference) runs on this one thread, which
+# serializes GPU access, keeps the event loop free for /health, and keeps
+# torch.compile's thread-local CUDA graphs on the thread that captured them
+gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr-gpu")
+
 class OCRRequest(BaseModel):
     image: str  # Base64 encoded image
     prompt: str = "<image>\nFree OCR."
@@ -48,8 +117,14 @@ def load_model():
     global model, tokenizer
 
     try:
-        logger.info(f"Loading DeepSeek-OCR model from {MODEL_PATH}")
-        logger.info(f"Using device: {DEVICE}")
+        logger.info("Loading DeepSeek-OCR model from %s", MODEL_PATH)
+        logger.info("Using device: %s (%s)", DEVICE, DTYPE)
+
+        if DEVICE == "cuda":
+            # TF32 for any fp32 matmuls/convs, autotuned cuDNN conv algorithms
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
 
         from transformers import AutoModel, AutoTokenizer
 
@@ -61,40 +136,290 @@ def load_model():
         )
 
         # Load model
-        logger.info("Loading model...")
-        model = AutoModel.from_pretrained(
-            str(MODEL_PATH),
+        logger.info("Loading model with %s attention...", ATTN_IMPLEMENTATION)
+        load_kwargs = dict(
             trust_remote_code=True,
-            use_safetensors=True
+            use_safetensors=True,
+            torch_dtype=DTYPE,
+            low_cpu_mem_usage=True,
+            device_map={"": DEVICE}
         )
+        quantization_config = build_quantization_config()
+        if quantization_config is not None:
+            load_kwargs["quantization_config"] = quantization_config
+        try:
+            model = AutoModel.from_pretrained(
+                str(MODEL_PATH),
+                attn_implementation=ATTN_IMPLEMENTATION,
+                **load_kwargs
+            )
+        except (ValueError, ImportError) as e:
+            # Remote model code may not declare support for the fused kernel
+            logger.warning("%s attention unavailable (%s), using default attention", ATTN_IMPLEMENTATION, e)
+            model = AutoModel.from_pretrained(str(MODEL_PATH), **load_kwargs)
 
-        # Move to device and set to evaluation mode
-        model = model.to(DEVICE)
+        # Weights are already on device in DTYPE, just set evaluation mode
         model = model.eval()
 
-        # Use bfloat16 for GPU if available
         if DEVICE == "cuda":
-            try:
-                model = model.to(torch.bfloat16)
-                logger.info("Using bfloat16 precision")
-            except:
-                logger.info("bfloat16 not available, using default precision")
+            # Channels-last conv weights select NHWC tensor-core kernels
+            for _, _, module in vision_encoders():
+                module.to(memory_format=torch.channels_last)
+
+        install_image_hook()
+        install_prompt_cache()
+
+        if USE_TORCH_COMPILE:
+            compile_vision_encoders()
 
-        logger.info("✅ Model loaded successfully!")
+        logger.info("Model loaded successfully")
         return True
 
     except Exception as e:
-        logger.error(f"❌ Failed to load model: {e}")
+        logger.error("Failed to load model: %s", e)
         return False
 
+def build_quantization_config():
+    """Build the bitsandbytes config selected by DEEPSEEK_OCR_QUANTIZATION, if any"""
+    if not QUANTIZATION:
+        return None
+    if DEVICE != "cuda":
+        logger.warning("Quantization requires CUDA, loading unquantized weights")
+        return None
+
+    from transformers import BitsAndBytesConfig
+
+    if QUANTIZATION == "8bit":
+        logger.info("Quantizing language decoder to INT8")
+        return BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_skip_modules=QUANTIZATION_SKIP_MODULES
+        )
+    if QUANTIZATION == "4bit":
+        logger.info("Quantizing language decoder to 4-bit NF4")
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=DTYPE,
+            llm_int8_skip_modules=QUANTIZATION_SKIP_MODULES
+        )
+
+    logger.warning("Unknown DEEPSEEK_OCR_QUANTIZATION=%r, expected 8bit or 4bit", QUANTIZATION)
+    return None
+
+def install_image_hook():
+    """Let model.infer take already-decoded images instead of re-reading them from disk"""
+    global image_hook_installed
+
+    # infer() only accepts an image path, which it opens with the remote
+    # module's load_image(), so intercept that lookup for preloaded images
+    remote_module = sys.modules.get(type(model).__module__)
+    load_image = getattr(remote_module, "load_image", None)
+    if load_image is None:
+        logger.info("Remote model code has no load_image(), images will go through temp files")
+        return
+
+    def load_preloaded_image(image_path):
+        # Preloaded images were already oriented and converted by decode_image()
+        image = preloaded_images.get(image_path)
+        return image if image is not None else load_image(image_path)
+
+    remote_module.load_image = load_preloaded_image
+    image_hook_installed = True
+    logger.info("Passing images to model.infer in memory")
+
+def install_prompt_cache():
+    """Memoize prompt tokenization, since every request sends one of a few fixed prompts"""
+    # The image tokens come before the prompt text, so the text's KV state
+    # depends on the image and can't be reused; only tokenization can be
+    remote_module = sys.modules.get(type(model).__module__)
+    text_encode = getattr(remote_module, "text_encode", None)
+    if text_encode is None:
+        return
+
+    @lru_cache(maxsize=PROMPT_CACHE_SIZE)
+    def encode_cached(text, bos, eos):
+        return tuple(text_encode(tokenizer, text, bos=bos, eos=eos))
+
+    def cached_text_encode(tok, text, bos=True, eos=False):
+        if tok is not tokenizer:
+            return text_encode(tok, text, bos=bos, eos=eos)
+        # Callers may mutate the returned list, so hand out a fresh copy
+        return list(encode_cached(text, bos, eos))
+
+    remote_module.text_encode = cached_text_encode
+    logger.info("Caching prompt token ids")
+
+def decode_image(image_bytes: bytes) -> Image.Image:
+    """Decode uploaded image bytes into an upright RGB PIL image without redundant copies on our side"""
+    # For JPEG, Image.open() and getexif() only parse the header, so this is
+    # cheap; PNG without an eXIf chunk is fully decoded here by getexif()
+    image = Image.open(io.BytesIO(image_bytes))
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+
+    if (turbo_jpeg is not None and image_bytes[:3] == JPEG_MAGIC
+            and orientation == 1 and image.mode in ("RGB", "L")):
+        # libjpeg-turbo decodes straight to a contiguous RGB array; it can't
+        # convert CMYK/YCCK JPEGs to RGB, so those stay on the Pillow path
+        return Image.fromarray(turbo_jpeg.decode(image_bytes, pixel_format=TJPF_RGB))
+
+    # PNG (what the extension uploads), rotated or CMYK JPEGs and the rest
+    # are decoded by Pillow. exif_transpose() and convert() both return
+    # full copies, so only call them when they change something
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        return image.convert("RGB")
+
+    image.load()
+    return image
+
+def decode_request_image(image_data: str) -> Image.Image:
+    """Decode a base64 (optionally data URL) image payload"""
+    # Remove data URL prefix if present
+    prefix, separator, image_data = image_data.partition(',')
+    if not separator:
+        image_data = prefix
+
+    # Decode base64
+    image_bytes = base64.b64decode(image_data)
+
+    # Convert to PIL Image
+    return decode_image(image_bytes)
+
+@contextmanager
+def staged_image(image: Image.Image):
+    """Yield an image_file value that model.infer can load the image from"""
+    if image_hook_installed:
+        image_file = f"memory://{id(image)}"
+        preloaded_images[image_file] = image
+        try:
+            yield image_file
+        finally:
+            preloaded_images.pop(image_file, None)
+        return
+
+    # Inference runs on a single thread, so one file per process is enough;
+    # overwriting it uncompressed skips PNG's DEFLATE pass on write and read
+    image.save(STAGED_IMAGE_PATH, format='BMP')
+    yield str(STAGED_IMAGE_PATH)
+
+def vision_encoders():
+    """Yield (parent, attribute name, module) for each vision encoder present in the model"""
+    inner = getattr(model, "model", model)
+    for name in VISION_ENCODERS:
+        module = getattr(inner, name, None)
+        if module is not None:
+            yield inner, name, module
+
+def compile_vision_encoders():
+    """Compile the vision encoders and warm up the global-view and typical screenshot crop graphs"""
+    originals = list(vision_encoders())
+    for inner, name, module in originals:
+        setattr(inner, name, torch.compile(module, mode=COMPILE_MODE, fullgraph=False))
+
+    if not originals:
+        logger.info("No vision encoders found to compile, running eager")
+        return
+
+    try:
+        logger.info("Compiling %s (warmup pass)...", ", ".join(name for _, name, _ in originals))
+        warmup_image = Image.new("RGB", (1920, 1080), "white")  # typical screenshot, takes the crop path
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                staged_image(warmup_image) as image_file:
+            # cudagraph trees run eagerly on the first call and only record
+            # the graphs on the second, so capture happens here too
+            for _ in range(2):
+                run_inference("<image>\nFree OCR.", image_file, temp_dir)
+        logger.info("torch.compile warmup completed")
+    except Exception as e:
+        # Compilation and capture errors only surface on these calls, so fall back to eager here
+        logger.warning("torch.compile failed (%s), falling back to eager mode", e)
+        for inner, name, module in originals:
+            setattr(inner, name, module)
+
+def run_inference(prompt: str, image_file: str, output_path: str):
+    """Run DeepSeek-OCR on an image file and return the recognized text"""
+    # Note: We're using the Gundam settings from README:
+    # base_size = 1024, image_size = 640, crop_mode = True
+    # eval_mode=True to get the return value instead of saving to file
+    # infer() builds the crop/global-view tensors itself and copies them with
+    # a blocking .cuda(), so there is no hook for pinned staging buffers or a
+    # separate H2D stream here; the copy is a few MB against seconds of decode
+    if USE_TORCH_COMPILE:
+        # Each infer() is one iteration, so CUDA graph outputs from the previous
+        # request may be overwritten by this one
+        torch.compiler.cudagraph_mark_step_begin()
+    return model.infer(
+        tokenizer,
+        prompt=prompt,
+        image_file=image_file,
+        output_path=output_path,
+        base_size=1024,
+        image_size=640,
+        crop_mode=True,
+        save_results=False,
+        test_compress=False,
+        eval_mode=True  # Set to True to get return value
+    )
+
+def run_ocr(prompt: str, image: Image.Image) -> str:
+    """Run OCR on a decoded image and return the recognized text"""
+    logger.info("Running OCR inference...")
+
+    # infer() always creates output_path (and an images/ subfolder) even though
+    # eval_mode returns the text without writing results, so give each request
+    # its own directory and let it be removed afterwards
+    with tempfile.TemporaryDirectory(prefix="deepseek_ocr_") as temp_dir, \
+            staged_image(image) as image_file:
+        # Call model infer method
+        output = run_inference(prompt, image_file, temp_dir)
+
+    logger.info("OCR inference completed, output type: %s", type(output))
+
+    # eval_mode=True returns the text directly; save_results=False writes no .mmd
+    if output is None:
+        output = ""
+
+    return output
+
+async def ocr_worker():
+    """Single GPU consumer running queued OCR requests one at a time"""
+    loop = asyncio.get_running_loop()
+    while True:
+        prompt, image, future = await ocr_queue.get()
+        if future.done():  # client went away
+            continue
+        try:
+            output = await loop.run_in_executor(gpu_executor, run_ocr, prompt, image)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(output)
+
 @app.on_event("startup")
 async def startup_event():
     """Load model on startup"""
-    success = load_model()
+    global ocr_queue, ocr_worker_task
+
+    success = await asyncio.get_running_loop().run_in_executor(gpu_executor, load_model)
     if not success:
         logger.error("Failed to start server - model loading failed")
         sys.exit(1)
 
+    ocr_queue = asyncio.Queue()
+    ocr_worker_task = asyncio.create_task(ocr_worker())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the OCR worker"""
+    if ocr_worker_task is not None:
+        ocr_worker_task.cancel()
+    gpu_executor.shutdown(wait=False)
+    STAGED_IMAGE_PATH.unlink(missing_ok=True)
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -120,86 +445,20 @@ async def ocr_endpoint(request: OCRRequest):
         # Decode base64 image
         logger.info("Received OCR request")
 
-        # Remove data URL prefix if present
-        image_data = request.image
-        if ',' in image_data:
-            image_data = image_data.split(',', 1)[1]
+        # Decode on a worker thread, overlapping with any inference in progress
+        image = await run_in_threadpool(decode_request_image, request.image)
 
-        # Decode base64
-        image_bytes = base64.b64decode(image_data)
-
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-
-        logger.info(f"Image size: {image.size}")
+        logger.info("Image size: %s", image.size)
 
         # Prepare prompt
         prompt = request.prompt
 
-        # Run inference
-        logger.info("Running OCR inference...")
-
-        # Create a temporary directory in current directory for output
-        import os
-        current_dir = Path.cwd()
-        temp_dir = current_dir / "tmp"
-        temp_dir.mkdir(exist_ok=True)
-
-        logger.info(f"Using temp directory: {temp_dir}")
-
-        # Generate unique filename for the image
-        import uuid
-        temp_image_path = temp_dir / f"{uuid.uuid4()}.png"
-
-        # Save image to file
-        image.save(temp_image_path, format='PNG')
-
-        logger.info(f"Saved temporary image to: {temp_image_path}")
-
-        try:
-            # Call model infer method
-            # Note: We're using the Gundam settings from README:
-            # base_size = 1024, image_size = 640, crop_mode = True
-            # eval_mode=True to get the return value instead of saving to file
-            output = model.infer(
-                tokenizer,
-                prompt=prompt,
-                image_file=str(temp_image_path),  # Pass file path, not PIL Image
-                output_path=str(temp_dir),  # Use temp directory for output
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                save_results=False,
-                test_compress=False,
-                eval_mode=True  # Set to True to get return value
-            )
-
-            logger.info(f"OCR inference completed, output type: {type(output)}")
-
-            # Check if output is valid
-            if output is None:
-                logger.warning("OCR returned None, checking for output files...")
-                # Check if there are any output files in temp_dir
-                output_files = list(temp_dir.glob("*.mmd"))
-                if output_files:
-                    logger.info(f"Found {len(output_files)} output files")
-                    with open(output_files[0], 'r', encoding='utf-8') as f:
-                        output = f.read()
-                else:
-                    output = ""
-
-        finally:
-            # Clean up temporary image file (keep the tmp directory for debugging)
-            try:
-                os.unlink(temp_image_path)
-                logger.info(f"Cleaned up temporary file: {temp_image_path}")
-            except:
-                pass
-
-        if output is None:
-            output = ""
+        # Queue for the GPU worker and wait for the result
+        future = asyncio.get_running_loop().create_future()
+        await ocr_queue.put((prompt, image, future))
+        output = await future
 
-        logger.info(f"✅ OCR completed, output length: {len(output)}")
+        logger.info("OCR completed, output length: %d", len(output))
 
         return OCRResponse(
             success=True,
@@ -207,7 +466,7 @@ async def ocr_endpoint(request: OCRRequest):
         )
 
     except Exception as e:
-        logger.error(f"OCR error: {e}", exc_info=True)
+        logger.error("OCR error: %s", e, exc_info=True)
         return OCRResponse(
             success=False,
             error=str(e)
@@ -227,14 +486,14 @@ if __name__ == "__main__":
 
     # Check if model path exists
     if not MODEL_PATH.exists():
-        logger.error(f"❌ Model path not found: {MODEL_PATH}")
+        logger.error("Model path not found: %s", MODEL_PATH)
         logger.error("Please download the model to the specified path")
         sys.exit(1)
 
     # Start server
-    logger.info("🚀 Starting DeepSeek-OCR Server...")
-    logger.info(f"Model path: {MODEL_PATH}")
-    logger.info(f"Device: {DEVICE}")
+    logger.info("Starting DeepSeek-OCR Server...")
+    logger.info("Model path: %s", MODEL_PATH)
+    logger.info("Device: %s", DEVICE)
 
     uvicorn.run(
         app,
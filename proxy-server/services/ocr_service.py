@@ -8,9 +8,13 @@ Author: Ling Luo
 
 import os
 import sys
-import base64
 import json
+import msgspec
+import orjson
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 from typing import Dict, Any, Optional, List
 from dotenv import load_dotenv
@@ -31,6 +35,69 @@ load_dotenv(env_path)
 # print(f"[ENV] Loading .env from: {env_path}")
 # print(f"[ENV] .env exists: {env_path.exists()}")
 
+def _dump_json(data: Dict[str, Any]) -> str:
+    """Serialize a result for stdout as indented UTF-8 JSON"""
+    try:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:
+        # orjson rejects integers wider than 64 bits, which msgspec decodes exactly
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+# Characters that can change JSON nesting state
+_JSON_TOKEN_PATTERN = re.compile(r'["\\{}]')
+
+
+def _find_json_object(text: str) -> Optional[str]:
+    """Return the first brace-balanced {...} object in text, ignoring braces inside strings"""
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped_pos = -1
+
+    # Single forward pass, jumping straight between structural characters
+    for match in _JSON_TOKEN_PATTERN.finditer(text, start):
+        pos = match.start()
+        if pos == escaped_pos:
+            continue
+
+        char = text[pos]
+        if in_string:
+            if char == '\\':
+                escaped_pos = pos + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+
+    return None
+
+
+class LLMAnalysis(msgspec.Struct):
+    """Analysis fields picked out of the LLM's JSON reply (other keys are ignored)"""
+    tags: List[Any] = []
+    actors: List[Any] = []
+    categories: List[Any] = []
+    keywords: List[Any] = []
+    summary: Optional[str] = ''
+    language: Optional[str] = 'unknown'
+    content_type: Optional[str] = 'unknown'
+    entities: Dict[str, Any] = {}
+
+
+# Parses, validates and builds LLMAnalysis in a single pass
+_analysis_decoder = msgspec.json.Decoder(LLMAnalysis)
+
+
 class OCRService:
     def __init__(self):
         self.ocr_api_url = os.getenv('DEEPSEEK_OCR_URL', 'http://localhost:8000/ocr')
@@ -51,6 +118,20 @@ class OCRService:
         else:
             self.llm_api_url = 'https://api.openai.com/v1/chat/completions'
 
+        # Reuse TCP/TLS connections across the OCR and LLM calls
+        self._session = requests.Session()
+        # POST is left out of urllib3's default allowed_methods, so only connect
+        # errors are retried: never re-send a POST whose request may already
+        # have reached the server (paid LLM completion, multi-MB OCR upload)
+        retry = Retry(
+            total=2,
+            backoff_factor=0.2,
+            raise_on_status=False  # hand back the last response so raise_for_status() reports it
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
         # Debug output to stderr
         print(f"[CONFIG] OCR URL: {self.ocr_api_url}", file=sys.stderr)
         print(f"[CONFIG] LLM URL: {self.llm_api_url}", file=sys.stderr)
@@ -78,8 +159,12 @@ class OCRService:
             existing_tags = request_data.get('existingTags', [])
 
             # Clean base64 string
-            if ',' in image_base64:
-                image_base64 = image_base64.split(',', 1)[1]
+            prefix, separator, image_base64 = image_base64.partition(',')
+            if not separator:
+                image_base64 = prefix
+
+            # Page context part of the LLM prompt (everything except OCR text)
+            context_parts = self._build_context_parts(url, title, content, existing_tags)
 
             # Step 1: OCR using DeepSeek-OCR
             ocr_result = self._run_ocr(image_base64)
@@ -96,8 +181,7 @@ class OCRService:
             # Step 2: LLM Analysis with full context
             analysis = self._run_llm_analysis(
                 ocr_text,
-                url,
-                title,
+                context_parts,
                 content,
                 existing_tags
             )
@@ -129,14 +213,15 @@ class OCRService:
                 'prompt': '<image>\nFree OCR. Extract all text content.'
             }
 
-            response = requests.post(
+            response = self._session.post(
                 self.ocr_api_url,
-                json=payload
+                data=orjson.dumps(payload),
+                headers={'Content-Type': 'application/json'}
                 # No timeout - let OCR complete naturally
             )
 
             response.raise_for_status()
-            result = response.json()
+            result = orjson.loads(response.content)
 
             if result.get('success'):
                 # print(f"[OCR] Completed successfully")
@@ -156,15 +241,14 @@ class OCRService:
             print(f"[ERROR] OCR API error: {e}", file=sys.stderr)
             return None
 
-    def _run_llm_analysis(self, ocr_text: str, url: str, title: str,
+    def _run_llm_analysis(self, ocr_text: str, context_parts: List[str],
                           content: Dict[str, Any], existing_tags: List[str]) -> Dict[str, Any]:
         """
         Analyze page content using LLM to extract entity information
 
         Args:
             ocr_text: OCR extracted text from screenshot
-            url: Page URL
-            title: Page title
+            context_parts: Page context sections from _build_context_parts
             content: Page content (text, excerpt, etc.)
             existing_tags: Tags already extracted from page
 
@@ -181,7 +265,7 @@ class OCRService:
             print(f"[LLM] - Content text: {content.get('wordCount', 0)} words", file=sys.stderr)
             print(f"[LLM] - Existing tags: {len(existing_tags)}", file=sys.stderr)
 
-            prompt = self._build_analysis_prompt(ocr_text, url, title, content, existing_tags)
+            prompt = self._build_analysis_prompt(ocr_text, context_parts)
 
             payload = {
                 'model': self.llm_model,
@@ -207,9 +291,9 @@ class OCRService:
             print(f"[LLM] Sending request to: {self.llm_api_url}", file=sys.stderr)
             print(f"[LLM] Using model: {self.llm_model}", file=sys.stderr)
 
-            response = requests.post(
+            response = self._session.post(
                 self.llm_api_url,
-                json=payload,
+                data=orjson.dumps(payload),
                 headers=headers,
                 timeout=30
             )
@@ -217,7 +301,7 @@ class OCRService:
             print(f"[LLM] Response status: {response.status_code}", file=sys.stderr)
             response.raise_for_status()
 
-            result = response.json()
+            result = orjson.loads(response.content)
 
             # Debug: print raw response structure
             print(f"[LLM] Response keys: {list(result.keys())}", file=sys.stderr)
@@ -256,9 +340,9 @@ class OCRService:
             print(f"[ERROR] Traceback: {traceback.format_exc()}", file=sys.stderr)
             return {}
 
-    def _build_analysis_prompt(self, ocr_text: str, url: str, title: str,
-                            content: Dict[str, Any], existing_tags: List[str]) -> str:
-        """Build the analysis prompt for the LLM with full context"""
+    def _build_context_parts(self, url: str, title: str,
+                             content: Dict[str, Any], existing_tags: List[str]) -> List[str]:
+        """Build the page context sections of the prompt (everything except OCR text)"""
 
         # Build context sections
         context_parts = []
@@ -279,16 +363,21 @@ class OCRService:
         if existing_tags and len(existing_tags) > 0:
             context_parts.append(f"**Existing Tags:** {', '.join(existing_tags[:10])}")
 
+        return context_parts
+
+    def _build_analysis_prompt(self, ocr_text: str, context_parts: List[str]) -> str:
+        """Build the analysis prompt for the LLM with full context"""
+
         # 5. OCR text
         # Truncate if too long (max 3000 chars for OCR)
         ocr_excerpt = ocr_text[:3000]
         if len(ocr_text) > 3000:
             ocr_excerpt += '\n...(OCR text truncated)'
 
-        context_parts.append(f"**OCR Text (from screenshot):**\n{ocr_excerpt}")
+        ocr_part = f"**OCR Text (from screenshot):**\n{ocr_excerpt}"
 
         # Combine all context
-        full_context = '\n\n'.join(context_parts)
+        full_context = '\n\n'.join(context_parts + [ocr_part])
 
         prompt = f"""你正在分析一个网页，以提取关于**主要实体**的结构化信息（电影、视频、文章、产品等）。
 
@@ -377,15 +466,15 @@ JSON:"""
     def _parse_llm_response(self, response: str) -> Dict[str, Any]:
         """Parse LLM response and extract JSON"""
         try:
-            # Try to extract JSON from response
-            import re
-
             # Find JSON object in response
-            json_match = re.search(r'\{[\s\S]*\}', response)
+            json_str = _find_json_object(response)
 
-            if json_match:
-                json_str = json_match.group(0)
-                data = json.loads(json_str)
+            if json_str:
+                try:
+                    return msgspec.structs.asdict(_analysis_decoder.decode(json_str))
+                except msgspec.ValidationError:
+                    # Unexpected field types, pass the values through as-is
+                    data = orjson.loads(json_str)
 
                 # Ensure all required fields exist
                 return {
@@ -399,21 +488,77 @@ JSON:"""
                     'entities': data.get('entities', {})
                 }
             else:
-                print("[WARNING] No JSON found in LLM response")
+                print("[WARNING] No JSON found in LLM response", file=sys.stderr)
                 return {}
 
-        except json.JSONDecodeError as e:
-            print(f"[WARNING] Failed to parse LLM JSON response: {e}")
+        except (msgspec.DecodeError, orjson.JSONDecodeError) as e:
+            print(f"[WARNING] Failed to parse LLM JSON response: {e}", file=sys.stderr)
             return {}
         except Exception as e:
-            print(f"[WARNING] Error parsing LLM response: {e}")
+            print(f"[WARNING] Error parsing LLM response: {e}", file=sys.stderr)
             return {}
 
 
+_service = None
+
+
+def get_service() -> OCRService:
+    """Return the process-wide OCRService, creating it on first use"""
+    global _service
+    if _service is None:
+        _service = OCRService()
+    return _service
+
+
+def serve(port: int):
+    """Run the OCR service as a persistent HTTP worker for the Node proxy"""
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import ORJSONResponse
+
+    class ResultResponse(ORJSONResponse):
+        def render(self, content: Any) -> bytes:
+            try:
+                return super().render(content)
+            except TypeError:
+                # Same big-integer fallback as _dump_json()
+                return json.dumps(content, ensure_ascii=False).encode()
+
+    app = FastAPI(title="Web2PG OCR Service", default_response_class=ResultResponse)
+    service = get_service()
+
+    @app.post("/process")
+    async def process(request: Request):
+        """Same JSON payload and result as the stdin/stdout mode"""
+        try:
+            request_data = orjson.loads(await request.body())
+        except orjson.JSONDecodeError as e:
+            return ORJSONResponse({'success': False, 'error': f'Invalid JSON input: {e}'}, status_code=400)
+
+        if not isinstance(request_data, dict) or 'image' not in request_data:
+            return ORJSONResponse({'success': False, 'error': 'Missing required field: image'}, status_code=400)
+
+        # process_screenshot blocks on HTTP calls, keep it off the event loop
+        return await run_in_threadpool(service.process_screenshot, request_data)
+
+    @app.get("/health")
+    async def health_check():
+        """Health check endpoint"""
+        return {'status': 'healthy'}
+
+    print(f"[CONFIG] Serving OCR service on http://127.0.0.1:{port}/process", file=sys.stderr)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="info")
+
+
 def main():
     """Test the OCR service"""
     import sys
 
+    if '--serve' in sys.argv:
+        serve(int(os.getenv('OCR_SERVICE_PORT', '8001')))
+        return
+
     # Debug: indicate script started
     print("[DEBUG] OCR service script started", file=sys.stderr)
     sys.stderr.flush()
@@ -435,56 +580,57 @@ def main():
             signal.alarm(10)  # 10 second timeout
 
         try:
-            input_data = sys.stdin.read().strip()
+            # Raw bytes: orjson parses UTF-8 directly, skipping a str decode of the payload
+            input_data = sys.stdin.buffer.read().strip()
 
             if hasattr(signal, 'SIGALRM'):
                 signal.alarm(0)  # Cancel alarm
         except TimeoutError:
             print("[ERROR] stdin read timeout after 10 seconds", file=sys.stderr)
-            print(json.dumps({
+            print(_dump_json({
                 'success': False,
                 'error': 'stdin read timeout'
-            }, indent=2, ensure_ascii=False))
+            }))
             sys.exit(1)
 
-        print(f"[DEBUG] Read {len(input_data)} characters from stdin", file=sys.stderr)
+        print(f"[DEBUG] Read {len(input_data)} bytes from stdin", file=sys.stderr)
 
         if not input_data:
             print("[ERROR] No data received from stdin", file=sys.stderr)
-            print(json.dumps({
+            print(_dump_json({
                 'success': False,
                 'error': 'No data provided via stdin'
-            }, indent=2, ensure_ascii=False))
+            }))
             sys.exit(1)
 
         # Parse JSON
         print("[DEBUG] Parsing JSON...", file=sys.stderr)
         try:
-            request_data = json.loads(input_data)
+            request_data = orjson.loads(input_data)
             print(f"[DEBUG] JSON parsed successfully", file=sys.stderr)
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"[ERROR] JSON decode error: {e}", file=sys.stderr)
-            print(f"[ERROR] First 200 chars of input: {input_data[:200]}", file=sys.stderr)
-            print(json.dumps({
+            print(f"[ERROR] First 200 bytes of input: {input_data[:200].decode('utf-8', errors='replace')}", file=sys.stderr)
+            print(_dump_json({
                 'success': False,
                 'error': f'Invalid JSON input: {e}'
-            }, indent=2, ensure_ascii=False))
+            }))
             sys.exit(1)
 
         # Validate required fields
         if 'image' not in request_data:
             print("[ERROR] Missing required field: image", file=sys.stderr)
-            print(json.dumps({
+            print(_dump_json({
                 'success': False,
                 'error': 'Missing required field: image'
-            }, indent=2, ensure_ascii=False))
+            }))
             sys.exit(1)
 
         print(f"[DEBUG] Request data keys: {list(request_data.keys())}", file=sys.stderr)
 
         # Process screenshot
         print("[DEBUG] Creating OCRService instance...", file=sys.stderr)
-        service = OCRService()
+        service = get_service()
         print("[DEBUG] Starting screenshot processing...", file=sys.stderr)
 
         result = service.process_screenshot(request_data)
@@ -492,17 +638,17 @@ def main():
         print(f"[DEBUG] Processing completed. Success: {result.get('success')}", file=sys.stderr)
 
         # Output result
-        print(json.dumps(result, indent=2, ensure_ascii=False))
+        print(_dump_json(result))
 
     except Exception as e:
         print(f"[ERROR] Unexpected error in main: {e}", file=sys.stderr)
         import traceback
         print(f"[ERROR] Traceback:\n{traceback.format_exc()}", file=sys.stderr)
 
-        print(json.dumps({
+        print(_dump_json({
             'success': False,
             'error': f'Unexpected error: {e}'
-        }, indent=2, ensure_ascii=False))
+        }))
         sys.exit(1)
 
 